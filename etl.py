@@ -1,11 +1,44 @@
 """File that runs the ETL process."""
 import configparser
-from datetime import datetime
 import os
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col
+from pyspark.sql.functions import col
 from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format
-from pyspark.sql.types import TimestampType
+from pyspark.sql.types import StructType, StructField, StringType, DoubleType, LongType, TimestampType
+
+
+# schemas of the JSON sources, only the columns used by the ETL are read
+SONG_SCHEMA = StructType([
+    StructField('song_id', StringType()),
+    StructField('title', StringType()),
+    StructField('artist_id', StringType()),
+    StructField('year', LongType()),
+    StructField('duration', DoubleType()),
+    StructField('artist_name', StringType()),
+    StructField('artist_location', StringType()),
+    StructField('artist_latitude', DoubleType()),
+    StructField('artist_longitude', DoubleType()),
+])
+
+LOG_SCHEMA = StructType([
+    StructField('ts', LongType()),
+    StructField('userId', StringType()),
+    StructField('firstName', StringType()),
+    StructField('lastName', StringType()),
+    StructField('gender', StringType()),
+    StructField('level', StringType()),
+    StructField('song', StringType()),
+    StructField('artist', StringType()),
+    StructField('sessionId', LongType()),
+    StructField('location', StringType()),
+    StructField('userAgent', StringType()),
+    StructField('length', DoubleType()),
+    StructField('page', StringType()),
+])
+
+
+# scratch location used when STAGING_PATH is not set in dl.cfg
+DEFAULT_STAGING_PATH = 'hdfs:///tmp/sparkify_staging'
 
 
 def create_config():
@@ -16,91 +49,128 @@ def create_config():
     os.environ['AWS_ACCESS_KEY_ID']=config['AWS']['AWS_ACCESS_KEY_ID']
     os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS']['AWS_SECRET_ACCESS_KEY']
 
-    INPUT_PATH = config['AWS']['INPUT_PATH']
-    OUTPUT_PATH = config['AWS']['OUTPUT_PATH']
+    # strip trailing slashes so joined paths do not contain '//'
+    INPUT_PATH = config['AWS']['INPUT_PATH'].rstrip('/')
+    OUTPUT_PATH = config['AWS']['OUTPUT_PATH'].rstrip('/')
+    # staging is optional in dl.cfg and defaults to a scratch location on the cluster
+    STAGING_PATH = (config['AWS'].get('STAGING_PATH') or DEFAULT_STAGING_PATH).rstrip('/')
 
     # uncomment for local mode
     #INPUT_PATH = 'data'
     #OUTPUT_PATH = 'output'
+    #STAGING_PATH = 'staging'
+
+    # the staging data is deleted after the run, so it must not share a folder with the data
+    for path in (INPUT_PATH, OUTPUT_PATH):
+        if STAGING_PATH == path or STAGING_PATH.startswith(path + '/'):
+            raise ValueError('STAGING_PATH {} must not be inside {}'.format(STAGING_PATH, path))
     
     print('config done')
     
-    return INPUT_PATH, OUTPUT_PATH
+    return INPUT_PATH, OUTPUT_PATH, STAGING_PATH
 
 def create_spark_session():
     """Create a spark session in AWS."""
     spark = SparkSession \
         .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
+        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:3.3.4") \
+        .config("spark.sql.execution.pythonUDF.arrow.enabled", "true") \
+        .config("spark.serializer", "org.apache.spark.serializer.KryoSerializer") \
+        .config("spark.kryo.registrationRequired", "false") \
+        .config("spark.sql.adaptive.enabled", "true") \
+        .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
+        .config("spark.sql.adaptive.advisoryPartitionSizeInBytes", str(128 * 1024 * 1024)) \
+        .config("spark.sql.adaptive.skewJoin.enabled", "true") \
+        .config("spark.sql.adaptive.localShuffleReader.enabled", "true") \
+        .config("spark.sql.autoBroadcastJoinThreshold", str(64 * 1024 * 1024)) \
+        .config("spark.sql.parquet.enableVectorizedReader", "true") \
+        .config("spark.sql.parquet.filterPushdown", "true") \
+        .config("spark.sql.parquet.compression.codec", "snappy") \
+        .config("spark.sql.sources.parallelPartitionDiscovery.threshold", "32") \
+        .config("spark.sql.sources.parallelPartitionDiscovery.parallelism", "10000") \
+        .config("spark.hadoop.mapreduce.input.fileinputformat.list-status.num-threads", "40") \
+        .config("spark.hadoop.fs.s3a.impl", "org.apache.hadoop.fs.s3a.S3AFileSystem") \
+        .config("spark.hadoop.fs.s3a.connection.maximum", "200") \
+        .config("spark.hadoop.fs.s3a.threads.max", "64") \
+        .config("spark.hadoop.fs.s3a.experimental.input.fadvise", "normal") \
         .getOrCreate()
     
     print('spark session created')
     
     return spark
 
-def process_song_data(spark, input_data, output_data):
+def stage_as_parquet(spark, df, path):
     """
-    Load data from song_data dataset and extract songs and artist tables 
-    and write the data back into a different bucket in parquet format
+    Write a dataframe to parquet files and read it back, so the following 
+    queries scan columnar parquet instead of the raw JSON files.
     
     Parameters
     ----------
     spark: session
           The spark session that has been created
-    input_data: path
-           The path to the song_data S3 bucket.
-    output_data: path
-            The path for the parquet files to be written.
+    df: dataframe
+           The dataframe read from the JSON source.
+    path: path
+            The path for the staging parquet files to be written.
     """
-    # get filepath to song data file
-    song_data = os.path.join(input_data + '/song_data/*/*/*/*.json')
+    df.write.mode('overwrite').parquet(path=path)
     
-    # read song data file
-    df = spark.read.json(song_data)
-    print('Song dataframe read')
-    
-    # save the original table in a new view
-    df.createOrReplaceTempView("songs")
-
-    # extract columns to create songs table
-    songs_table = spark.sql("""
-                        SELECT DISTINCT a.song_id
-                            ,a.title
-                            ,a.artist_id
-                            ,a.year
-                            ,a.duration
-                        FROM songs a
-                        """)
+    return spark.read.parquet(path)
 
-    songs_table.createOrReplaceTempView('songs')
+def delete_path(spark, path):
+    """
+    Recursively delete a path through the Hadoop filesystem of the spark session.
     
-    # write songs table to parquet files partitioned by year and artist
-    songs_table.write.mode('overwrite').partitionBy("year", "artist_id").parquet(path=output_data + '/songs')
+    Parameters
+    ----------
+    spark: session
+          The spark session that has been created
+    path: path
+            The path to be deleted.
+    """
+    hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration()).delete(hadoop_path, True)
 
-    # save the original table in a new view
-    df.createOrReplaceTempView("artists")
+def process_song_data(df, output_data):
+    """
+    Extract songs and artist tables from the song_data dataset 
+    and write the data back into a different bucket in parquet format
+    
+    Parameters
+    ----------
+    df: dataframe
+           The song_data dataset read by main.
+    output_data: path
+            The path for the parquet files to be written.
+    """
+    # extract columns to create songs table, one row per song
+    songs_table = df.select('song_id', 'title', 'artist_id', 'year', 'duration') \
+        .dropDuplicates(['song_id'])
     
-    # extract columns to create artists table
-    artists_table = spark.sql("""
-                            SELECT DISTINCT a.artist_id
-                                ,a.artist_name as name
-                                ,a.artist_location as locaton
-                                ,a.artist_latitude as latitude
-                                ,a.artist_longitude as longitude
-                            FROM artists a                    
-                            """)
+    # write songs table to parquet files partitioned by year, range partitioned on artist
+    # as well so large years (year 0 holds many songs) are split over several tasks,
+    # sorted by artist so parquet statistics can skip row groups on artist lookups
+    songs_table.repartitionByRange(200, "year", "artist_id") \
+        .sortWithinPartitions("artist_id") \
+        .write.mode('overwrite').partitionBy("year").parquet(path=f"{output_data}/songs")
 
-    artists_table.createOrReplaceTempView('artists')
+    # extract columns to create artists table, one row per artist
+    artists_table = df.select('artist_id',
+                              col('artist_name').alias('name'),
+                              col('artist_location').alias('locaton'),
+                              col('artist_latitude').alias('latitude'),
+                              col('artist_longitude').alias('longitude')) \
+        .dropDuplicates(['artist_id'])
     
-    # write artists table to parquet files
-    artists_table.write.mode('overwrite').parquet(path=output_data + '/artists')
+    # write artists table to parquet files, the table is small enough for a single file
+    artists_table.coalesce(1).write.mode('overwrite').parquet(path=f"{output_data}/artists")
     
     print('processed songs')
     
 
-def process_log_data(spark, input_data, output_data):
+def process_log_data(spark, df, output_data, song_df):
     """
-    Load the data from log_data and extract columns for users and time tables, 
+    Extract columns for users and time tables from the log_data dataset, 
     using the log_data and song_data. The data is written into parquet files 
     amd written on a different S3 as specified in the config file.
     
@@ -108,27 +178,20 @@ def process_log_data(spark, input_data, output_data):
     ----------
     spark: session
           The spark session that has been created
-    input_data: path
-           The path to the song_data S3 bucket.
+    df: dataframe
+           The log_data dataset read by main.
     output_data: path
             The path for the parquet files to be written.
+    song_df: dataframe
+            The song_data dataset read by main, used for the songplays table.
     """
     
-    # get filepath to log data file
-    log_data = os.path.join(input_data + '/log_data/*/*/*.json')
-    # change path mask for local mode
-    #log_data = os.path.join(input_data + '/log_data/*.json')
-
-    # read log data file
-    df = spark.read.json(log_data)
-    print('Log dataframe read')
-    
     # save the original table in a new view
     df.createOrReplaceTempView("logs")
     
-    # filter by actions for song plays and cast userId as integer
+    # cast userId as integer, the data is already filtered to song plays
     logs_table = spark.sql("""
-                        SELECT DISTINCT a.ts
+                        SELECT a.ts
                             ,CAST(a.userId AS int) AS userId
                             ,a.firstName
                             ,a.lastName
@@ -140,70 +203,69 @@ def process_log_data(spark, input_data, output_data):
                             ,a.location
                             ,a.userAgent
                             ,a.length
-                        FROM logs a 
-                        WHERE a.page LIKE "NextSong"
+                        FROM logs a
                         """)
 
     logs_table.createOrReplaceTempView('logs')
     
-    # extract columns for users table    
+    # extract columns for users table, keeping the latest record of each user
     users_table = spark.sql("""
                         SELECT b.userId
-                            ,b.firstName
-                            ,b.lastName
-                            ,b.gender
-                            ,b.level
-                        FROM (                            
-                            SELECT DISTINCT a.userId
-                                ,a.firstName
-                                ,a.lastName
-                                ,a.gender
-                                ,a.level
-                                ,a.ts
-                                ,ROW_NUMBER() OVER (PARTITION BY a.userID ORDER BY a.ts DESC) AS ROWNUM
-                            FROM logs a ) b
-                        WHERE b.ROWNUM = 1
+                            ,b.latest.firstName
+                            ,b.latest.lastName
+                            ,b.latest.gender
+                            ,b.latest.level
+                        FROM (
+                            SELECT a.userId
+                                ,max(struct(a.ts
+                                    ,a.firstName
+                                    ,a.lastName
+                                    ,a.gender
+                                    ,a.level)) AS latest
+                            FROM logs a
+                            WHERE a.userId IS NOT NULL
+                            GROUP BY a.userId ) b
                         """)
 
     users_table.createOrReplaceTempView('users')
 
-    # write users table to parquet files
-    users_table.write.mode('overwrite').parquet(path=output_data + '/users')
+    # write users table to parquet files, the table is small enough for a single file
+    users_table.coalesce(1).write.mode('overwrite').parquet(path=f"{output_data}/users")
 
-    # create timestamp column from original timestamp column
-    get_timestamp = udf(lambda x: str(int(int(x)/1000)))
-    logs_table = logs_table.withColumn('timestamp', get_timestamp(logs_table.ts))
-     
-    # create datetime column from original timestamp column
-    get_datetime = udf(lambda x: datetime.fromtimestamp(int(x) / 1000),TimestampType())
-    logs_table = logs_table.withColumn('datetime', get_datetime(logs_table.ts))
+    # create datetime column from original epoch millisecond timestamp column
+    logs_table = logs_table.withColumn('datetime', (col('ts') / 1000).cast(TimestampType()))
     
     # save the original table with new columns once again in a new view
     logs_table.createOrReplaceTempView("logs")
      
     # extract columns to create time table
     time_table = spark.sql("""
-                    SELECT DISTINCT a.datetime AS start_time
+                    SELECT a.datetime AS start_time
                         ,hour(a.datetime) AS hour
                         ,day(a.datetime) AS day
                         ,weekofyear(a.datetime) AS week
                         ,month(a.datetime) AS month
                         ,year(a.datetime) AS year
-                        ,dayofweek(a.datetime) AS weekday                       
-                    FROM logs a
+                        ,dayofweek(a.datetime) AS weekday
+                    FROM (
+                        SELECT DISTINCT b.datetime
+                        FROM logs b ) a
                     """)
     
-    # write time table to parquet files partitioned by year and month
-    time_table.write.mode('overwrite').partitionBy("year", "month").parquet(path=output_data + '/time')
+    # write time table to parquet files partitioned by year and month,
+    # range partitioned on start_time as well so a single month is spread over several files
+    time_table.repartitionByRange(col('year'), col('month'), col('start_time')) \
+        .write.mode('overwrite').partitionBy("year", "month").parquet(path=f"{output_data}/time")
 
-    # read in song data to use for songplays table
-    song_data = os.path.join(input_data + '/song_data/*/*/*/*.json')
-    song_df = spark.read.json(song_data)
-    song_df.createOrReplaceTempView("song_data")
+    # use the already read song data for songplays table, only the join columns are needed
+    song_df.select('song_id', 'title', 'artist_id', 'artist_name', 'duration') \
+        .createOrReplaceTempView("song_data")
 
-    # extract columns from joined song and log datasets to create songplays table 
+    # extract columns from joined song and log datasets to create songplays table,
+    # each song is repeated for the whole second buckets within 2 seconds of its duration
+    # so the length match can be joined on equality and only checked exactly afterwards
     songplays_table = spark.sql("""
-                        SELECT monotonically_increasing_id() as songplay_id
+                        SELECT /*+ BROADCAST(s) */ xxhash64(l.datetime, l.userId, l.sessionId, s.song_id) as songplay_id
                             ,l.datetime as start_time
                             ,l.userId as user_id
                             ,l.level as level
@@ -215,14 +277,25 @@ def process_log_data(spark, input_data, output_data):
                             ,year(l.datetime) as year
                             ,month(l.datetime) as month
                         FROM logs l
-                        LEFT JOIN song_data s
+                        LEFT JOIN (
+                            SELECT a.song_id
+                                ,a.artist_id
+                                ,a.title
+                                ,a.artist_name
+                                ,a.duration
+                                ,explode(sequence(CAST(a.duration AS int) - 2
+                                    ,CAST(a.duration AS int) + 2)) AS duration_bucket
+                            FROM song_data a ) s
                         ON (l.song = s.title
                             AND l.artist = s.artist_name
+                            AND CAST(l.length AS int) = s.duration_bucket
                             AND ABS(l.length - s.duration) <2 )
                         """)
 
-    # write songplays table to parquet files partitioned by year and month
-    songplays_table.write.mode('overwrite').partitionBy("year", "month").parquet(path=output_data + '/songplays')
+    # write songplays table to parquet files partitioned by year and month,
+    # range partitioned on start_time as well so a single month is spread over several files
+    songplays_table.repartitionByRange(col('year'), col('month'), col('start_time')) \
+        .write.mode('overwrite').partitionBy("year", "month").parquet(path=f"{output_data}/songplays")
 
     print('processed logs')
 
@@ -230,21 +303,52 @@ def main():
     """
     Main orchestrator function:
     Create a spark session.
+    Read song and log data and stage them as parquet
     Process song data
     Process log data
+    Remove staging data
     Close spark session
     """
-    input_data, output_data = create_config()
+    input_data, output_data, staging_data = create_config()
     
     spark = create_spark_session()
     
     print('using input folder: {}'.format(input_data))
     print('using output folder: {}'.format(output_data))
+    print('using staging folder: {}'.format(staging_data))
     
-    process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+    # get filepaths to song and log data files and their staging copies
+    song_data = f"{input_data}/song_data/*/*/*/*.json"
+    song_staging = f"{staging_data}/song_data"
+    log_data = f"{input_data}/log_data/*/*/*.json"
+    # change path mask for local mode
+    #log_data = f"{input_data}/log_data/*.json"
+    log_staging = f"{staging_data}/log_data"
+
+    try:
+        # read song data file once, it is used by both processing steps
+        song_df = spark.read.schema(SONG_SCHEMA).json(song_data)
+        song_df = stage_as_parquet(spark, song_df, song_staging).cache()
+        print('Song dataframe read')
+
+        # read log data file, keeping only song plays and the columns used later
+        log_df = spark.read.schema(LOG_SCHEMA).json(log_data) \
+            .filter(col('page') == 'NextSong') \
+            .select('ts', 'userId', 'firstName', 'lastName', 'gender', 'level',
+                    'song', 'artist', 'sessionId', 'location', 'userAgent', 'length')
+        log_df = stage_as_parquet(spark, log_df, log_staging)
+        print('Log dataframe read')
+
+        process_song_data(song_df, output_data)
+        process_log_data(spark, log_df, output_data, song_df)
+
+        song_df.unpersist()
+    finally:
+        # remove the staging copies even if a step failed, they hold raw log data
+        delete_path(spark, song_staging)
+        delete_path(spark, log_staging)
 
-    spark.stop()
+        spark.stop()
     
 if __name__ == "__main__":
     main()